@@ -1,28 +1,282 @@
 ''' Class ranking method: FAI '''
 
+import io
+import os
+import sys
+import csv
+import json
+import time
 import logging
+import cProfile
+from collections import OrderedDict
+from datetime import datetime
+import gevent
+import gevent.lock
+import gevent.subprocess
 import RHUtils
 from eventmanager import Evt
 from RHRace import StartBehavior
 from Results import RaceClassRankMethod
 from RHUI import UIField, UIFieldType, UIFieldSelectOption
+from Database import ProgramMethod, HeatStatus
+from flask import Blueprint, Response, request
+from .bracket import FaiBracket
+
+try:
+    import numpy
+except ImportError:
+    # Only needed for predictions
+    numpy = None
 
 #
 # @author Arnaud Morin <arnaud.morin@gmail.com>
 #
 # FAI doc link: https://www.fai.org/sites/default/files/ciam/wcup_drones/sc4_vol_f9_dronesport_24_0.pdf
 
+# Where profiling captures are written (relative to the server directory)
+PROFILE_DIR = 'fai_profiles'
+
+# How many pilots are kept in the shared pilot cache
+PILOT_CACHE_SIZE = 512
+
+# Default points given for each position in season standings
+SEASON_POINTS = '25,20,16,13,11,10,9,8,7,6,5,4,3,2,1'
+
+# Bracket types by number of heats
+BRACKET_TYPES = {
+    62: 'fai64de',
+    32: 'fai64',
+    30: 'fai32de',
+    16: 'fai32',
+    14: 'fai16de',
+    8: 'fai16',
+    6: 'fai8de',
+    4: 'fai8',
+}
+
+# Number of bracket completions sampled for predictions by default, and the
+# sample counts a request is snapped to (the largest one must stay well under
+# a second on a Raspberry Pi, it runs in the server loop)
+PREDICT_SAMPLES = 2000
+PREDICT_SAMPLE_STEPS = (250, 500, 1000, 2000)
+
+# Delay (in seconds) before warming up rankings at startup, and pause between classes
+WARMUP_DELAY = 5
+WARMUP_PAUSE = 0.1
+
+# Script of the ranking worker process
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+# Seconds given to the worker to answer, before ranking in process
+WORKER_TIMEOUT = 10
+
 
 def initialize(rhapi):
     ranker = FaiRank(rhapi)
     rhapi.events.on(Evt.CLASS_RANK_INITIALIZE, ranker.register_handlers)
+    rhapi.events.on(Evt.STARTUP, ranker.warmup, name='fai_warmup')
+    # Seed the next heats of the bracket as soon as a heat is saved
+    rhapi.events.on(Evt.LAPS_SAVE, ranker.advance_bracket, name='fai_advance')
+    rhapi.events.on(Evt.LAPS_RESAVE, ranker.advance_bracket, name='fai_advance')
+    # Anything that may change a ranking makes the cached leaderboards stale
+    # (adding or generating heats also changes the bracket type, and a
+    # restored or imported DB changes everything)
+    for evt in (Evt.LAPS_SAVE, Evt.LAPS_RESAVE, Evt.HEAT_ADD, Evt.HEAT_DUPLICATE, Evt.HEAT_GENERATE,
+                Evt.HEAT_ALTER, Evt.HEAT_DELETE, Evt.CLASS_ALTER, Evt.CLASS_DELETE, Evt.PILOT_ALTER,
+                Evt.DATABASE_RESET, Evt.DATABASE_RESTORE, Evt.DATABASE_RECOVER, Evt.DATABASE_IMPORT):
+        rhapi.events.on(evt, ranker.invalidate, name='fai_invalidate')
+    # Keep the shared pilot cache in sync with the DB
+    rhapi.events.on(Evt.PILOT_ALTER, PILOT_CACHE.on_pilot_change, name='fai_pilot_cache')
+    rhapi.events.on(Evt.PILOT_DELETE, PILOT_CACHE.on_pilot_change, name='fai_pilot_cache')
+    # A new DB may give other callsigns to the same pilot ids
+    for evt in (Evt.DATABASE_RESET, Evt.DATABASE_RESTORE, Evt.DATABASE_RECOVER, Evt.DATABASE_IMPORT):
+        rhapi.events.on(evt, PILOT_CACHE.on_reset, name='fai_pilot_cache')
+    # Plugin wide options
+    rhapi.ui.register_panel('class_rank_fai', 'FAI Ranking', 'format')
+    rhapi.fields.register_option(UIField(
+        name='fai-season-classes',
+        label='Season Classes',
+        field_type=UIFieldType.TEXT,
+        desc="Comma separated ids of the FAI classes counting for the season standings.",
+    ), 'class_rank_fai')
+    rhapi.fields.register_option(UIField(
+        name='fai-season-points',
+        label='Season Points',
+        field_type=UIFieldType.TEXT,
+        placeholder=SEASON_POINTS,
+        desc="Comma separated points given for each position in a class.",
+    ), 'class_rank_fai')
+    rhapi.fields.register_option(UIField(
+        name='fai-rank-worker',
+        label='Rank in Worker Process',
+        field_type=UIFieldType.CHECKBOX,
+        desc="Compute FAI leaderboards in a separate process so that big brackets never stall the server.",
+    ), 'class_rank_fai')
+    rhapi.ui.blueprint_add(ranker.blueprint())
+
+
+class PilotCache():
+    """Size-bounded LRU cache of pilot_id -> callsign, shared by all FAI classes"""
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._callsigns = OrderedDict()
+
+    def callsign(self, pilot_id, loader):
+        """Return the callsign of a pilot, using loader(pilot_id) on cache miss"""
+        try:
+            callsign = self._callsigns[pilot_id]
+        except KeyError:
+            self.misses += 1
+            callsign = loader(pilot_id).callsign
+            self._callsigns[pilot_id] = callsign
+            if len(self._callsigns) > self.size:
+                # Evict the least recently used pilot
+                self._callsigns.popitem(last=False)
+            return callsign
+        self.hits += 1
+        self._callsigns.move_to_end(pilot_id)
+        return callsign
+
+    def invalidate(self, pilot_id):
+        self._callsigns.pop(pilot_id, None)
+
+    def clear(self):
+        self._callsigns.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._callsigns),
+            'max_size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
 
+    def on_pilot_change(self, args):
+        """Event handler for pilot alter / delete"""
+        if args.get('pilot_id') is None:
+            self.clear()
+        else:
+            self.invalidate(args['pilot_id'])
 
-class FaiRank():
+    def on_reset(self, args):
+        """Event handler for DB reset, restore, recover and import"""
+        self.clear()
+
+
+PILOT_CACHE = PilotCache(PILOT_CACHE_SIZE)
+
+
+class SeasonStandings():
+    """Season points aggregated from the leaderboards of several FAI classes
+
+    Each class contribution is kept apart, so a changed class only replaces
+    its own contribution in the totals.
+    """
+    def __init__(self):
+        self._points = []
+        # class_id -> (leaderboard version, {pilot_id: points})
+        self._contributions = {}
+        # pilot_id -> {'points': n, 'events': n}
+        self._totals = {}
+        self._callsigns = {}
+
+    def configure(self, class_ids, points):
+        """Set the classes and points table of the season"""
+        if points != self._points:
+            # Every contribution is wrong now, start over
+            self._points = points
+            self._contributions = {}
+            self._totals = {}
+        for class_id in list(self._contributions):
+            if class_id not in class_ids:
+                self.remove_class(class_id)
+
+    def update_class(self, class_id, version, leaderboard):
+        """Replace the contribution of a class, if its leaderboard changed"""
+        previous = self._contributions.get(class_id)
+        if previous and previous[0] == version:
+            return
+        self.remove_class(class_id)
+
+        contribution = {}
+        for row in leaderboard:
+            if not row['pilot_id']:
+                continue
+            position = row.get('position', 0)
+            if 0 < position <= len(self._points):
+                contribution[row['pilot_id']] = self._points[position - 1]
+            else:
+                contribution[row['pilot_id']] = 0
+            self._callsigns[row['pilot_id']] = row['callsign']
+
+        for pilot_id, points in contribution.items():
+            total = self._totals.setdefault(pilot_id, {'points': 0, 'events': 0})
+            total['points'] += points
+            total['events'] += 1
+        self._contributions[class_id] = (version, contribution)
+
+    def remove_class(self, class_id):
+        """Remove the contribution of a class from the totals"""
+        previous = self._contributions.pop(class_id, None)
+        if not previous:
+            return
+        for pilot_id, points in previous[1].items():
+            total = self._totals[pilot_id]
+            total['points'] -= points
+            total['events'] -= 1
+            if not total['events']:
+                del self._totals[pilot_id]
+
+    def standings(self):
+        """Return the season leaderboard"""
+        rows = sorted(
+            self._totals.items(),
+            key=lambda x: (-x[1]['points'], self._callsigns.get(x[0], '')),
+        )
+        return [
+            {
+                'position': i,
+                'pilot_id': pilot_id,
+                'callsign': self._callsigns.get(pilot_id, ''),
+                'points': total['points'],
+                'events': total['events'],
+            }
+            for i, (pilot_id, total) in enumerate(rows, start=1)
+        ]
+
+
+class FaiRank(FaiBracket):
     """This class handles will do compute a ranking based on FAI rules"""
     def __init__(self, rhapi):
         self.logger = logging.getLogger(__name__)
         self._rhapi = rhapi
+        # class_id -> [requested, captured] for profiling captures
+        self._profiles = {}
+        # class_id -> {'version': n, 'leaderboard': [...]} served to overlays
+        self._leaderboards = {}
+        # class_ids whose cached leaderboard is known to be up to date
+        self._fresh = set()
+        # Make sure ETags from a previous run are never considered valid
+        self._epoch = int(time.time())
+        self._season = SeasonStandings()
+        self._method = None
+        # Ranking worker process, started on first use
+        self._worker = None
+        self._worker_lock = gevent.lock.Semaphore()
+        # Set when the worker failed, ranking is then done in process
+        self._worker_failed = False
+        # bracket_type -> leaderboard slot groups
+        self._slots = {}
+        # class_id -> inputs of the last ranking (snapshot of heats, etc.)
+        self._inputs = {}
+        # class_id -> state of the last ranking (results per heat number, etc.)
+        self._results = {}
+        # class_id -> (leaderboard version, what-if analysis)
+        self._whatif = {}
+        # class_id -> (leaderboard version, {samples: prediction})
+        self._predictions = {}
 
     def register_handlers(self, args):
         """Register the "rank" as handler of ranking for classes"""
@@ -49,17 +303,269 @@ class FaiRank():
             options=options,
             desc="Qualifying stage used to rank pilots",
         )
-        args['register_fn'](
-            RaceClassRankMethod(
-                "FAI",
-                self.rank,
-                {'rank-fai-qualifid': 0, 'rank-fai-cta': False},
-                [qualifid, cta],
-            )
+        profile = UIField(
+            name='rank-fai-profile',
+            label='Profile next rankings',
+            field_type=UIFieldType.BASIC_INT,
+            desc="Capture a profiler trace of the next N rankings of this class (0 to disable).",
+        )
+        advance = UIField(
+            name='rank-fai-advance',
+            label='Seed next heats on save',
+            field_type=UIFieldType.CHECKBOX,
+            desc="Seed all the next heats of the bracket at once when a heat is saved.",
+        )
+        self._method = RaceClassRankMethod(
+            "FAI",
+            self.rank,
+            {'rank-fai-qualifid': 0, 'rank-fai-cta': False, 'rank-fai-profile': 0, 'rank-fai-advance': False},
+            [qualifid, cta, profile, advance],
         )
+        args['register_fn'](self._method)
 
-    def rank(self, _, race_class, args):
+    def rank(self, rhapi, race_class, args):
         """Callback to perform the ranking"""
+        # Capture a profiler trace if requested in class settings
+        try:
+            requested = int(args.get('rank-fai-profile') or 0)
+        except (TypeError, ValueError):
+            requested = 0
+
+        capture = self._profiles.get(race_class.id)
+        if not capture or capture[0] != requested:
+            # Setting changed, start counting again
+            capture = self._profiles[race_class.id] = [requested, 0]
+
+        if capture[1] >= capture[0]:
+            leaderboard, meta = self._rank(rhapi, race_class, args)
+        else:
+            capture[1] += 1
+            profiler = cProfile.Profile()
+            leaderboard, meta = profiler.runcall(self._rank, rhapi, race_class, args)
+            try:
+                self.dump_profile(profiler, race_class, args)
+            except Exception as e:
+                self.logger.error(f'FAI-rank-plugin: failed to write profile {e}')
+            if capture[1] >= capture[0]:
+                # Turn the setting off once done, so that a restart does not capture again
+                # Deferred: the class must not be altered while RH builds its results
+                gevent.spawn(self.stop_profiling, race_class.id)
+
+        self.store_leaderboard(race_class.id, leaderboard)
+        return leaderboard, meta
+
+    def stop_profiling(self, class_id):
+        """Set "Profile next rankings" of a class back to 0"""
+        try:
+            race_class = self._rhapi.db.raceclass_by_id(class_id)
+            if not race_class:
+                return
+            settings = self.class_settings(race_class)
+            settings['rank-fai-profile'] = 0
+            self._rhapi.db.raceclass_alter(class_id, rank_settings=settings)
+        except Exception as e:
+            self.logger.error(f'FAI-rank-plugin: failed to turn profiling off for class {class_id} {e}')
+
+    def warmup(self, args):
+        """Rank all FAI classes in background so that caches are hot for the first request"""
+        gevent.spawn(self.warmup_classes)
+
+    def warmup_classes(self):
+        gevent.sleep(WARMUP_DELAY)
+        for race_class in self._rhapi.db.raceclasses:
+            if not self.is_fai_class(race_class):
+                continue
+            try:
+                if not self.guess_bracket(race_class.id):
+                    continue
+                # Qualification ranking first, it is needed by rank
+                qualifid = self.class_settings(race_class).get('rank-fai-qualifid')
+                if qualifid:
+                    self._rhapi.db.raceclass_ranking(qualifid)
+                # Fill RH results cache, then our own state if rank was not called
+                self._rhapi.db.raceclass_ranking(race_class.id)
+                self.class_state(race_class.id)
+            except Exception as e:
+                self.logger.error(f'FAI-rank-plugin: failed to warm up class {race_class.id} {e}')
+            # Let the server breathe between classes
+            gevent.sleep(WARMUP_PAUSE)
+        self.logger.info('FAI-rank-plugin: rankings warmed up')
+
+    def invalidate(self, args):
+        """Mark all cached leaderboards as stale"""
+        self._fresh.clear()
+        # The bracket topology may have changed even if leaderboards did not
+        self._whatif.clear()
+        self._predictions.clear()
+
+    def store_leaderboard(self, class_id, leaderboard):
+        """Keep a copy of the leaderboard, bumping its version only if it changed"""
+        cached = self._leaderboards.get(class_id)
+        if not cached:
+            self._leaderboards[class_id] = {'version': 1, 'leaderboard': leaderboard}
+        elif cached['leaderboard'] != leaderboard:
+            cached['version'] += 1
+            cached['leaderboard'] = leaderboard
+        self._fresh.add(class_id)
+
+    def cached_leaderboard(self, class_id):
+        """Return the cached leaderboard of a class, refreshing it only if stale"""
+        if class_id not in self._fresh:
+            # This goes through the RH results cache, and calls rank only if needed
+            ranking = self._rhapi.db.raceclass_ranking(class_id)
+            if not ranking or ranking['meta'].get('method_label') != "FAI":
+                return None
+            self.store_leaderboard(class_id, ranking['ranking'])
+        return self._leaderboards.get(class_id)
+
+    def season_settings(self):
+        """Read the season classes and points table from plugin options"""
+        class_ids = []
+        for c in (self._rhapi.db.option('fai-season-classes') or '').split(','):
+            try:
+                class_ids.append(int(c))
+            except ValueError:
+                continue
+        points = []
+        for p in (self._rhapi.db.option('fai-season-points') or SEASON_POINTS).split(','):
+            try:
+                points.append(int(p))
+            except ValueError:
+                points.append(0)
+        return class_ids, points
+
+    def season_standings(self):
+        """Update the season with classes whose leaderboard changed and return it"""
+        class_ids, points = self.season_settings()
+        self._season.configure(class_ids, points)
+        for class_id in class_ids:
+            cached = self.cached_leaderboard(class_id)
+            if cached is None:
+                self._season.remove_class(class_id)
+                continue
+            self._season.update_class(class_id, cached['version'], cached['leaderboard'])
+        return self._season.standings()
+
+    def blueprint(self):
+        """Read-only export of the FAI leaderboards, for stream overlays"""
+        bp = Blueprint('class_rank_fai', __name__, url_prefix='/fai')
+
+        @bp.route('/<int:class_id>/leaderboard.json')
+        def leaderboard_json(class_id):
+            return self.export_leaderboard(class_id, 'json')
+
+        @bp.route('/<int:class_id>/leaderboard.csv')
+        def leaderboard_csv(class_id):
+            return self.export_leaderboard(class_id, 'csv')
+
+        @bp.route('/<int:class_id>/whatif.json')
+        def whatif_json(class_id):
+            analysis = self.whatif(class_id)
+            if analysis is None:
+                return Response('No ranked FAI bracket in this class', status=404)
+            return Response(json.dumps(analysis), mimetype='application/json')
+
+        @bp.route('/<int:class_id>/predict.json')
+        def predict_json(class_id):
+            if numpy is None:
+                return Response('numpy is required for predictions', status=501)
+            # Snapped to a few values, so that overlays share cached predictions
+            samples = request.args.get('samples', PREDICT_SAMPLES, type=int)
+            samples = max([s for s in PREDICT_SAMPLE_STEPS if s <= samples], default=PREDICT_SAMPLE_STEPS[0])
+            prediction = self.predict(class_id, samples)
+            if prediction is None:
+                return Response('No ranked FAI bracket in this class', status=404)
+            return Response(json.dumps(prediction), mimetype='application/json')
+
+        @bp.route('/<int:class_id>/pilot/<int:pilot_id>.json')
+        def journey_json(class_id, pilot_id):
+            journey = self.journey(class_id, pilot_id)
+            if journey is None:
+                return Response('No such pilot in this FAI class', status=404)
+            return Response(json.dumps(journey), mimetype='application/json')
+
+        @bp.route('/season.json')
+        def season_json():
+            return Response(json.dumps(self.season_standings()), mimetype='application/json')
+
+        @bp.route('/pilot-cache.json')
+        def pilot_cache_stats():
+            return Response(json.dumps(PILOT_CACHE.stats()), mimetype='application/json')
+
+        return bp
+
+    def export_leaderboard(self, class_id, fmt):
+        """Serve the cached leaderboard, answering 304 if the client is up to date"""
+        cached = self.cached_leaderboard(class_id)
+        if cached is None:
+            return Response('Not an FAI class', status=404)
+
+        etag = f"{self._epoch}-{class_id}-{cached['version']}"
+        if request.if_none_match.contains(etag):
+            # Client is up to date, do not even build the body
+            response = Response(status=304)
+        elif fmt == 'csv':
+            out = io.StringIO()
+            writer = csv.writer(out)
+            writer.writerow(['position', 'pilot_id', 'callsign', 'points'])
+            for row in cached['leaderboard']:
+                writer.writerow([row.get('position'), row['pilot_id'], row['callsign'], row.get('points', '')])
+            response = Response(out.getvalue(), mimetype='text/csv')
+        else:
+            body = json.dumps({
+                'class_id': class_id,
+                'version': cached['version'],
+                'leaderboard': cached['leaderboard'],
+            })
+            response = Response(body, mimetype='application/json')
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    def dump_profile(self, profiler, race_class, args):
+        """Write the profiler trace and a sanitized dump of the ranking inputs"""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        base = os.path.join(PROFILE_DIR, f'fai-rank-{race_class.id}-{stamp}')
+
+        profiler.dump_stats(f'{base}.prof')
+
+        # Dump exactly what was ranked, from the snapshot taken by _rank
+        # Only keep ids and positions, callsigns are not needed to replay
+        ranked = self._inputs.get(race_class.id, {})
+        inputs = {
+            'class_id': race_class.id,
+            'args': args,
+            'bracket_type': ranked.get('bracket_type'),
+            # Without the 0 added at the end by _rank
+            'qualification': ranked.get('q_pilots', [])[:-1],
+            'heats': [
+                {
+                    'id': heat['id'],
+                    'name': heat['name'],
+                    'races': [
+                        None if race is None else [
+                            {'pilot_id': result['pilot_id'], 'position': result['position']}
+                            for result in race
+                        ]
+                        for race in heat['races']
+                    ],
+                }
+                for heat in ranked.get('heats', [])
+            ],
+        }
+
+        with open(f'{base}.json', 'w') as f:
+            json.dump(inputs, f, indent=2)
+
+        self.logger.info(f'FAI-rank-plugin: profile written to {base}.prof')
+
+    def _rank(self, _, race_class, args):
+        """Perform the ranking"""
+        # A failed or empty ranking must not leave the previous one behind
+        self._inputs.pop(race_class.id, None)
+        self._results.pop(race_class.id, None)
         meta = {
             'method_label': "FAI",
             'rank_fields': [
@@ -106,659 +612,494 @@ class FaiRank():
 
         # Encapsulate in a big try/catch so any failure won't stop the results cache to be built
         try:
-            # Let's build our class rank now
-            results = {}
-            # Get heats of this class
-            # Heats are supposed to be sorted from DB but better safe than sorry
-            heats = [heat for heat in sorted(self._rhapi.db.heats_by_class(race_class.id), key=lambda h: h.id)]
-            heat_number = 0
-            for heat in heats:
-                heat_number += 1
-                races = self._rhapi.db.races_by_heat(heat.id)
-
-                for race in races:
-                    raceresults = {}
-                    # Grab the race result
-                    r = self._rhapi.db.race_results(race.id)
-                    if r != None:
-                        # What is important for us is position more than laps
-                        # Take only the results that are used to make progress
-                        filteredresults = r[r["meta"]["primary_leaderboard"]]
-
-                        for result in filteredresults:
-                            pilot = self._rhapi.db.pilot_by_id(result['pilot_id'])
-                            new_pilot_result = {
-                                'pilot_id': pilot.id,
-                                'callsign': pilot.callsign,
-                                'win': 0,
-                                'points': 0,
-                            }
-                            # Handle chase-the-ace (successive final races in FAI doc)
-                            # TODO stop using Final, but last of len(heats) instead
-                            if heat.name == "Final" and args['rank-fai-cta']:
-                                if result['position'] == 1:
-                                    new_pilot_result['win'] = 1
-                                new_pilot_result['points'] = result['position']
-                                if heat_number in results:
-                                    for r in results[heat_number].values():
-                                        if r['pilot_id'] == pilot.id:
-                                            # We increase the point based on the position - this is how FAI does
-                                            if result['position']:
-                                                new_pilot_result['points'] = r['points'] + result['position']
-                                            else:
-                                                # If pilot is not having any position, let's add 4
-                                                new_pilot_result['points'] = r['points'] + 4
-                                            if result['position'] == 1:
-                                                new_pilot_result['win'] = r['win'] + 1
-                            raceresults[result['position']] = new_pilot_result
-
-                        # Let's sort raceresults for Final
-                        if heat.name == "Final" and args['rank-fai-cta']:
-                            # Sort by keeping first the one that wone twice
-                            # then by increasing points
-                            # We also need to sort by qualifying stage if two of them are deuce
-                            sorted_raceresults = sorted(
-                                raceresults.values(),
-                                key=lambda x: (x['win'] != 2, x['points'], q_pilots.index(x['pilot_id']))
-                            )
-                            # Rebuild our dict
-                            raceresults = {
-                                1: sorted_raceresults[0],
-                                2: sorted_raceresults[1],
-                                3: sorted_raceresults[2],
-                                4: sorted_raceresults[3],
-                            }
-
-                    # Add this result, this may override a previous race that was done
-                    # for the same heat ID, but that's fine, we are looping over race in
-                    # ordered way so we should have the latest one
-                    results[heat_number] = raceresults
-
-            if bracket_type == 'fai64de':
-                leaderboard = self.build_leaderboard_fai64de(results, q_pilots)
-            if bracket_type == 'fai64':
-                leaderboard = self.build_leaderboard_fai64(results, q_pilots)
-            if bracket_type == 'fai32de':
-                leaderboard = self.build_leaderboard_fai32de(results, q_pilots)
-            if bracket_type == 'fai32':
-                leaderboard = self.build_leaderboard_fai32(results, q_pilots)
-            if bracket_type == 'fai16de':
-                leaderboard = self.build_leaderboard_fai16de(results, q_pilots)
-            if bracket_type == 'fai16':
-                leaderboard = self.build_leaderboard_fai16(results, q_pilots)
-            if bracket_type == 'fai8de':
-                leaderboard = self.build_leaderboard_fai8de(results, q_pilots)
-            if bracket_type == 'fai8':
-                leaderboard = self.build_leaderboard_fai8(results, q_pilots)
-
-            # determine ranking
-            for i, row in enumerate(leaderboard, start=1):
-                pos = i
-                row['position'] = pos
+            heats = self.snapshot_heats(race_class.id)
+            self._inputs[race_class.id] = {
+                'bracket_type': bracket_type,
+                'q_pilots': q_pilots,
+                'heats': heats,
+            }
+            if self.use_worker():
+                leaderboard, results = self.compute_in_worker(bracket_type, heats, q_pilots, args['rank-fai-cta'])
+            else:
+                leaderboard, results = self.compute_leaderboard(bracket_type, heats, q_pilots, args['rank-fai-cta'])
+            self._results[race_class.id] = {
+                'bracket_type': bracket_type,
+                'results': results,
+                'q_pilots': q_pilots,
+                'cta': args['rank-fai-cta'],
+                'journeys': self.build_journeys(heats, results, leaderboard),
+            }
         except Exception as e:
             self.logger.error(f'FAI-rank-plugin: failed to rank {e}')
             return [], meta
 
         return leaderboard, meta
 
-    def build_leaderboard_fai64de(self, results, q_pilots):
-        # 9 to 12: 3 and 4 in race 57 and 58
-        a = [
-            self.try_get_value(results, 57, 3),
-            self.try_get_value(results, 57, 4),
-            self.try_get_value(results, 58, 3),
-            self.try_get_value(results, 58, 4),
-        ]
+    def snapshot_heats(self, class_id):
+        """Grab from DB what is needed to rank a class: the ordered heats and
+        the primary leaderboard of each of their races"""
+        heats = []
+        # Heats are supposed to be sorted from DB but better safe than sorry
+        for heat in sorted(self._rhapi.db.heats_by_class(class_id), key=lambda h: h.id):
+            races = []
+            for race in self._rhapi.db.races_by_heat(heat.id):
+                # Grab the race result
+                r = self._rhapi.db.race_results(race.id)
+                if r == None:
+                    races.append(None)
+                    continue
+                # What is important for us is position more than laps
+                # Take only the results that are used to make progress
+                races.append([
+                    {
+                        'pilot_id': result['pilot_id'],
+                        'callsign': PILOT_CACHE.callsign(result['pilot_id'], self._rhapi.db.pilot_by_id),
+                        'position': result['position'],
+                    }
+                    for result in r[r["meta"]["primary_leaderboard"]]
+                ])
+            heats.append({'id': heat.id, 'name': heat.name, 'races': races})
+        return heats
 
-        # 13 to 16: 3 and 4 in race 53 and 54
-        b = [
-            self.try_get_value(results, 53, 3),
-            self.try_get_value(results, 53, 4),
-            self.try_get_value(results, 54, 3),
-            self.try_get_value(results, 54, 4),
-        ]
+    def build_journeys(self, heats, results, leaderboard):
+        """Index, by pilot_id, the heats flown by each pilot and their final position"""
+        journeys = {}
+        for heat_number, raceresults in sorted(results.items()):
+            for position, row in sorted(raceresults.items(), key=lambda x: x[0] or 0):
+                if not row['pilot_id']:
+                    continue
+                journey = journeys.setdefault(row['pilot_id'], {
+                    'pilot_id': row['pilot_id'],
+                    'callsign': row['callsign'],
+                    'heats': [],
+                    'position': None,
+                })
+                journey['heats'].append({
+                    'heat_number': heat_number,
+                    'name': heats[heat_number - 1]['name'],
+                    'position': position,
+                })
+        for row in leaderboard:
+            if row['pilot_id'] in journeys:
+                journeys[row['pilot_id']]['position'] = row['position']
+        return journeys
 
-        # 17 to 24: 3 and 4 in race 49 to 52
-        c = [
-            self.try_get_value(results, 49, 3),
-            self.try_get_value(results, 49, 4),
-            self.try_get_value(results, 50, 3),
-            self.try_get_value(results, 50, 4),
-            self.try_get_value(results, 51, 3),
-            self.try_get_value(results, 51, 4),
-            self.try_get_value(results, 52, 3),
-            self.try_get_value(results, 52, 4),
-        ]
+    def journey(self, class_id, pilot_id):
+        """Return the journey of a pilot through the bracket of a class"""
+        state = self.class_state(class_id)
+        if not state:
+            return None
+        return state['journeys'].get(pilot_id)
 
-        # 25 to 32: 3 and 4 in race 41 to 44
-        d = [
-            self.try_get_value(results, 41, 3),
-            self.try_get_value(results, 41, 4),
-            self.try_get_value(results, 42, 3),
-            self.try_get_value(results, 42, 4),
-            self.try_get_value(results, 43, 3),
-            self.try_get_value(results, 43, 4),
-            self.try_get_value(results, 44, 3),
-            self.try_get_value(results, 44, 4),
-        ]
+    def use_worker(self):
+        """Whether ranking is done in a worker process"""
+        if self._worker_failed:
+            return False
+        return str(self._rhapi.db.option('fai-rank-worker')).lower() in ('1', 'true')
 
-        # 33 to 48: 3 and 4 in race 33 to 40
-        e = [
-            self.try_get_value(results, 33, 3),
-            self.try_get_value(results, 33, 4),
-            self.try_get_value(results, 34, 3),
-            self.try_get_value(results, 34, 4),
-            self.try_get_value(results, 35, 3),
-            self.try_get_value(results, 35, 4),
-            self.try_get_value(results, 36, 3),
-            self.try_get_value(results, 36, 4),
-            self.try_get_value(results, 37, 3),
-            self.try_get_value(results, 37, 4),
-            self.try_get_value(results, 38, 3),
-            self.try_get_value(results, 38, 4),
-            self.try_get_value(results, 39, 3),
-            self.try_get_value(results, 39, 4),
-            self.try_get_value(results, 40, 3),
-            self.try_get_value(results, 40, 4),
-        ]
+    def compute_in_worker(self, bracket_type, heats, q_pilots, cta):
+        """Run compute_leaderboard in the worker process, letting other greenlets run meanwhile
 
-        # 49 to 64: 3 and 4 in race 25 to 32
-        f = [
-            self.try_get_value(results, 25, 3),
-            self.try_get_value(results, 25, 4),
-            self.try_get_value(results, 26, 3),
-            self.try_get_value(results, 26, 4),
-            self.try_get_value(results, 27, 3),
-            self.try_get_value(results, 27, 4),
-            self.try_get_value(results, 28, 3),
-            self.try_get_value(results, 28, 4),
-            self.try_get_value(results, 29, 3),
-            self.try_get_value(results, 29, 4),
-            self.try_get_value(results, 30, 3),
-            self.try_get_value(results, 30, 4),
-            self.try_get_value(results, 31, 3),
-            self.try_get_value(results, 31, 4),
-            self.try_get_value(results, 32, 3),
-            self.try_get_value(results, 32, 4),
-        ]
+        The worker is a dedicated script talking JSON lines over stdin/stdout,
+        it never imports the server. If it fails or does not answer in time,
+        it is turned off for the session and ranking is done in process.
+        """
+        request = json.dumps({
+            'bracket_type': bracket_type,
+            'heats': heats,
+            'q_pilots': q_pilots,
+            'cta': cta,
+        }) + '\n'
+        with self._worker_lock:
+            try:
+                if self._worker is None:
+                    self._worker = gevent.subprocess.Popen(
+                        [sys.executable, WORKER_SCRIPT],
+                        stdin=gevent.subprocess.PIPE,
+                        stdout=gevent.subprocess.PIPE,
+                    )
+                # A hung worker must not block every later ranking
+                with gevent.Timeout(WORKER_TIMEOUT, TimeoutError('worker timed out')):
+                    self._worker.stdin.write(request.encode())
+                    self._worker.stdin.flush()
+                    line = self._worker.stdout.readline()
+                if not line:
+                    raise EOFError('worker exited')
+                reply = json.loads(line)
+            except (OSError, EOFError, ValueError) as e:
+                self.logger.error(f'FAI-rank-plugin: ranking worker failed, ranking in process from now on {e}')
+                self._worker_failed = True
+                self.stop_worker()
+                return self.compute_leaderboard(bracket_type, heats, q_pilots, cta)
 
-        # Sort them based on qualifications
-        a = sorted(a, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        b = sorted(b, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        c = sorted(c, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        d = sorted(d, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        e = sorted(e, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        f = sorted(f, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
+        if 'error' in reply:
+            # Ranking itself failed, not the worker
+            raise RuntimeError(reply['error'])
+        results = {
+            heat_number: {position: row for position, row in raceresults}
+            for heat_number, raceresults in reply['results']
+        }
+        return reply['leaderboard'], results
 
-        # Build our final leaderboard
-        return [
-            self.try_get_value(results, 62, 1),
-            self.try_get_value(results, 62, 2),
-            self.try_get_value(results, 62, 3),
-            self.try_get_value(results, 62, 4),
-            self.try_get_value(results, 61, 3),
-            self.try_get_value(results, 61, 4),
-            self.try_get_value(results, 59, 3),
-            self.try_get_value(results, 59, 4),
-            a[0],
-            a[1],
-            a[2],
-            a[3],
-            b[0],
-            b[1],
-            b[2],
-            b[3],
-            c[0],
-            c[1],
-            c[2],
-            c[3],
-            c[4],
-            c[5],
-            c[6],
-            c[7],
-            d[0],
-            d[1],
-            d[2],
-            d[3],
-            d[4],
-            d[5],
-            d[6],
-            d[7],
-            e[0],
-            e[1],
-            e[2],
-            e[3],
-            e[4],
-            e[5],
-            e[6],
-            e[7],
-            e[8],
-            e[9],
-            e[10],
-            e[11],
-            e[12],
-            e[13],
-            e[14],
-            e[15],
-            f[0],
-            f[1],
-            f[2],
-            f[3],
-            f[4],
-            f[5],
-            f[6],
-            f[7],
-            f[8],
-            f[9],
-            f[10],
-            f[11],
-            f[12],
-            f[13],
-            f[14],
-            f[15],
-        ]
+    def stop_worker(self):
+        """Stop the ranking worker process, if any"""
+        if self._worker is None:
+            return
+        try:
+            self._worker.kill()
+            # Reap it, so that it does not stay a zombie
+            self._worker.wait()
+        except OSError:
+            pass
+        self._worker = None
 
-    def build_leaderboard_fai64(self, results, q_pilots):
-        # 9 to 16: 3 and 4 in race 25 to 28
-        a = [
-            self.try_get_value(results, 25, 3),
-            self.try_get_value(results, 25, 4),
-            self.try_get_value(results, 26, 3),
-            self.try_get_value(results, 26, 4),
-            self.try_get_value(results, 27, 3),
-            self.try_get_value(results, 27, 4),
-            self.try_get_value(results, 28, 3),
-            self.try_get_value(results, 28, 4),
-        ]
+    def is_fai_class(self, race_class):
+        """Whether the class is ranked with this method"""
+        return bool(self._method) and race_class.win_condition == self._method.name
 
-        # 17 to 32: 3 and 4 in race 17 to 24
-        b = [
-            self.try_get_value(results, 17, 3),
-            self.try_get_value(results, 17, 4),
-            self.try_get_value(results, 18, 3),
-            self.try_get_value(results, 18, 4),
-            self.try_get_value(results, 19, 3),
-            self.try_get_value(results, 19, 4),
-            self.try_get_value(results, 20, 3),
-            self.try_get_value(results, 20, 4),
-            self.try_get_value(results, 21, 3),
-            self.try_get_value(results, 21, 4),
-            self.try_get_value(results, 22, 3),
-            self.try_get_value(results, 22, 4),
-            self.try_get_value(results, 23, 3),
-            self.try_get_value(results, 23, 4),
-            self.try_get_value(results, 24, 3),
-            self.try_get_value(results, 24, 4),
-        ]
+    def class_settings(self, race_class):
+        """Return the FAI settings of a class, with defaults"""
+        settings = dict(self._method.default_args) if self._method else {}
+        rank_settings = race_class.rank_settings
+        if isinstance(rank_settings, str):
+            try:
+                rank_settings = json.loads(rank_settings)
+            except ValueError:
+                rank_settings = None
+        if rank_settings:
+            settings.update(rank_settings)
+        return settings
 
-        # 33 to 64: 3 and 4 in race 1 to 16
-        c = [
-            self.try_get_value(results, 1, 3),
-            self.try_get_value(results, 1, 4),
-            self.try_get_value(results, 2, 3),
-            self.try_get_value(results, 2, 4),
-            self.try_get_value(results, 3, 3),
-            self.try_get_value(results, 3, 4),
-            self.try_get_value(results, 4, 3),
-            self.try_get_value(results, 4, 4),
-            self.try_get_value(results, 5, 3),
-            self.try_get_value(results, 5, 4),
-            self.try_get_value(results, 6, 3),
-            self.try_get_value(results, 6, 4),
-            self.try_get_value(results, 7, 3),
-            self.try_get_value(results, 7, 4),
-            self.try_get_value(results, 8, 3),
-            self.try_get_value(results, 8, 4),
-            self.try_get_value(results, 9, 3),
-            self.try_get_value(results, 9, 4),
-            self.try_get_value(results, 10, 3),
-            self.try_get_value(results, 10, 4),
-            self.try_get_value(results, 11, 3),
-            self.try_get_value(results, 11, 4),
-            self.try_get_value(results, 12, 3),
-            self.try_get_value(results, 12, 4),
-            self.try_get_value(results, 13, 3),
-            self.try_get_value(results, 13, 4),
-            self.try_get_value(results, 14, 3),
-            self.try_get_value(results, 14, 4),
-            self.try_get_value(results, 15, 3),
-            self.try_get_value(results, 15, 4),
-            self.try_get_value(results, 16, 3),
-            self.try_get_value(results, 16, 4),
-        ]
+    def heat_positions(self, heat_id):
+        """Return {position: pilot_id} for the latest race of a heat"""
+        races = self._rhapi.db.races_by_heat(heat_id)
+        if not races:
+            return {}
+        r = self._rhapi.db.race_results(races[-1].id)
+        if r is None:
+            return {}
+        return {
+            result['position']: result['pilot_id']
+            for result in r[r["meta"]["primary_leaderboard"]]
+        }
 
-        # Sort them based on qualifications
-        a = sorted(a, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        b = sorted(b, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        c = sorted(c, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
+    def advance_bracket(self, args):
+        """Seed every downstream heat of the bracket in a single transaction"""
+        try:
+            race = self._rhapi.db.race_by_id(args.get('race_id'))
+            if not race:
+                return
+            heat = self._rhapi.db.heat_by_id(race.heat_id)
+            if not heat or not heat.class_id:
+                return
+            race_class = self._rhapi.db.raceclass_by_id(heat.class_id)
+            if not race_class or not self.is_fai_class(race_class):
+                return
+            if not self.class_settings(race_class).get('rank-fai-advance'):
+                return
 
-        # Build our final leaderboard
-        return [
-            self.try_get_value(results, 32, 1),
-            self.try_get_value(results, 32, 2),
-            self.try_get_value(results, 32, 3),
-            self.try_get_value(results, 32, 4),
-            self.try_get_value(results, 31, 1),
-            self.try_get_value(results, 31, 2),
-            self.try_get_value(results, 31, 3),
-            self.try_get_value(results, 31, 4),
-            a[0],
-            a[1],
-            a[2],
-            a[3],
-            a[4],
-            a[5],
-            a[6],
-            a[7],
-            b[0],
-            b[1],
-            b[2],
-            b[3],
-            b[4],
-            b[5],
-            b[6],
-            b[7],
-            b[8],
-            b[9],
-            b[10],
-            b[11],
-            b[12],
-            b[13],
-            b[14],
-            b[15],
-            c[0],
-            c[1],
-            c[2],
-            c[3],
-            c[4],
-            c[5],
-            c[6],
-            c[7],
-            c[8],
-            c[9],
-            c[10],
-            c[11],
-            c[12],
-            c[13],
-            c[14],
-            c[15],
-            c[16],
-            c[17],
-            c[18],
-            c[19],
-            c[20],
-            c[21],
-            c[22],
-            c[23],
-            c[24],
-            c[25],
-            c[26],
-            c[27],
-            c[28],
-            c[29],
-            c[30],
-            c[31],
-        ]
+            # Walk the bracket topology (slots seeded from heat results) and
+            # compute the new seeding of every heat that was not flown yet
+            positions = {}
+            updates = []
+            for h in self._rhapi.db.heats_by_class(race_class.id):
+                if h.status == HeatStatus.CONFIRMED or self._rhapi.db.races_by_heat(h.id):
+                    continue
+                for slot in self._rhapi.db.slots_by_heat(h.id):
+                    if slot.method != ProgramMethod.HEAT_RESULT or not slot.seed_id or not slot.seed_rank:
+                        continue
+                    if slot.seed_id not in positions:
+                        positions[slot.seed_id] = self.heat_positions(slot.seed_id)
+                    pilot_id = positions[slot.seed_id].get(slot.seed_rank)
+                    if pilot_id and pilot_id != slot.pilot_id:
+                        updates.append({'slot_id': slot.id, 'pilot': pilot_id})
 
-    def build_leaderboard_fai32de(self, results, q_pilots):
-        # 9 to 12: 3 and 4 in race 25 and 26
-        a = [
-            self.try_get_value(results, 25, 3),
-            self.try_get_value(results, 25, 4),
-            self.try_get_value(results, 26, 3),
-            self.try_get_value(results, 26, 4),
-        ]
+            if not updates:
+                return
+            # One commit for all the slots
+            self._rhapi.db.slots_alter_fast(updates)
+            # slots_alter_fast does not notify anyone, push the new lineups to clients once
+            self._rhapi.ui.broadcast_heats()
+            self.logger.info(f'FAI-rank-plugin: seeded {len(updates)} slots in class {race_class.id}')
+        except Exception as e:
+            self.logger.error(f'FAI-rank-plugin: failed to advance bracket {e}')
 
-        # 13 to 16: 3 and 4 in race 21 and 22
-        b = [
-            self.try_get_value(results, 21, 3),
-            self.try_get_value(results, 21, 4),
-            self.try_get_value(results, 22, 3),
-            self.try_get_value(results, 22, 4),
-        ]
+    def class_state(self, class_id):
+        """Return the state of the last ranking of a class, ranking it again if stale"""
+        if class_id not in self._fresh or class_id not in self._results:
+            race_class = self._rhapi.db.raceclass_by_id(class_id)
+            if not race_class or not self.is_fai_class(race_class):
+                return None
+            # Not through rank, this must not use up profiling captures
+            leaderboard, _ = self._rank(self._rhapi, race_class, self.class_settings(race_class))
+            self.store_leaderboard(class_id, leaderboard)
+        return self._results.get(class_id)
 
-        # 17 to 24: 3 and 4 in race 17 to 20
-        c = [
-            self.try_get_value(results, 17, 3),
-            self.try_get_value(results, 17, 4),
-            self.try_get_value(results, 18, 3),
-            self.try_get_value(results, 18, 4),
-            self.try_get_value(results, 19, 3),
-            self.try_get_value(results, 19, 4),
-            self.try_get_value(results, 20, 3),
-            self.try_get_value(results, 20, 4),
-        ]
+    def bracket_topology(self, class_id):
+        """Return, by heat number, the heat name and its inputs: either
+        ('heat', heat number, position) for slots seeded from a heat result of
+        the bracket, or ('pilot', pilot_id) for slots already known"""
+        heats = sorted(self._rhapi.db.heats_by_class(class_id), key=lambda h: h.id)
+        numbers = {heat.id: i for i, heat in enumerate(heats, start=1)}
+        topology = {}
+        for heat_number, heat in enumerate(heats, start=1):
+            inputs = []
+            for slot in self._rhapi.db.slots_by_heat(heat.id):
+                if slot.method == ProgramMethod.HEAT_RESULT and slot.seed_id in numbers and slot.seed_rank:
+                    inputs.append(('heat', numbers[slot.seed_id], slot.seed_rank))
+                elif slot.pilot_id:
+                    inputs.append(('pilot', slot.pilot_id))
+            topology[heat_number] = (heat.name, inputs)
+        return topology
 
-        # 25 to 32: 3 and 4 in race 13 to 16
-        d = [
-            self.try_get_value(results, 13, 3),
-            self.try_get_value(results, 13, 4),
-            self.try_get_value(results, 14, 3),
-            self.try_get_value(results, 14, 4),
-            self.try_get_value(results, 15, 3),
-            self.try_get_value(results, 15, 4),
-            self.try_get_value(results, 16, 3),
-            self.try_get_value(results, 16, 4),
-        ]
+    def state_topology(self, class_id, state):
+        """Return the bracket topology of a class, or None if it does not
+        match the bracket type of the last ranking (heats added or deleted)"""
+        topology = self.bracket_topology(class_id)
+        if BRACKET_TYPES.get(len(topology)) != state['bracket_type']:
+            return None
+        return topology
 
-        # Sort them based on qualifications
-        a = sorted(a, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        b = sorted(b, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        c = sorted(c, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        d = sorted(d, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
+    def heat_decided(self, state, topology, heat_number):
+        """Whether the result of a heat is final"""
+        raceresults = state['results'].get(heat_number)
+        if not raceresults:
+            return False
+        if state['cta'] and topology[heat_number][0] == "Final":
+            # Chase the ace is over only when someone won twice
+            return any(x['win'] >= 2 for x in raceresults.values())
+        return True
 
-        # Build our final leaderboard
-        return [
-            self.try_get_value(results, 30, 1),
-            self.try_get_value(results, 30, 2),
-            self.try_get_value(results, 30, 3),
-            self.try_get_value(results, 30, 4),
-            self.try_get_value(results, 29, 3),
-            self.try_get_value(results, 29, 4),
-            self.try_get_value(results, 27, 3),
-            self.try_get_value(results, 27, 4),
-            a[0],
-            a[1],
-            a[2],
-            a[3],
-            b[0],
-            b[1],
-            b[2],
-            b[3],
-            c[0],
-            c[1],
-            c[2],
-            c[3],
-            c[4],
-            c[5],
-            c[6],
-            c[7],
-            d[0],
-            d[1],
-            d[2],
-            d[3],
-            d[4],
-            d[5],
-            d[6],
-            d[7],
-        ]
+    def whatif(self, class_id):
+        """Return the guaranteed best and worst final position of each pilot,
+        whatever the outcome of the remaining heats"""
+        state = self.class_state(class_id)
+        if not state:
+            return None
+        version = self._leaderboards[class_id]['version']
+        cached = self._whatif.get(class_id)
+        if cached and cached[0] == version:
+            return cached[1]
 
-    def build_leaderboard_fai32(self, results, q_pilots):
-        # 9 to 16: 3 and 4 in race 9 to 12
-        a = [
-            self.try_get_value(results, 9, 3),
-            self.try_get_value(results, 9, 4),
-            self.try_get_value(results, 10, 3),
-            self.try_get_value(results, 10, 4),
-            self.try_get_value(results, 11, 3),
-            self.try_get_value(results, 11, 4),
-            self.try_get_value(results, 12, 3),
-            self.try_get_value(results, 12, 4),
-        ]
+        topology = self.state_topology(class_id, state)
+        if topology is None:
+            return None
+        results = state['results']
+        q_pilots = state['q_pilots']
 
-        # 17 to 32: 3 and 4 in race 1 to 8
-        b = [
-            self.try_get_value(results, 1, 3),
-            self.try_get_value(results, 1, 4),
-            self.try_get_value(results, 2, 3),
-            self.try_get_value(results, 2, 4),
-            self.try_get_value(results, 3, 3),
-            self.try_get_value(results, 3, 4),
-            self.try_get_value(results, 4, 3),
-            self.try_get_value(results, 4, 4),
-            self.try_get_value(results, 5, 3),
-            self.try_get_value(results, 5, 4),
-            self.try_get_value(results, 6, 3),
-            self.try_get_value(results, 6, 4),
-            self.try_get_value(results, 7, 3),
-            self.try_get_value(results, 7, 4),
-            self.try_get_value(results, 8, 3),
-            self.try_get_value(results, 8, 4),
-        ]
+        # heat number -> ({position: pilot_id} if the heat is decided, or
+        # None, [set of pilots possible for each entrant] otherwise)
+        # Decided heats prune the walk up their subtree, and each heat is
+        # computed only once even if it seeds several heats
+        heats = {}
 
-        # Sort them based on qualifications
-        a = sorted(a, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        b = sorted(b, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
+        def heat(heat_number):
+            if heat_number in heats:
+                return heats[heat_number]
+            if self.heat_decided(state, topology, heat_number):
+                heats[heat_number] = (
+                    {position: x['pilot_id'] for position, x in results[heat_number].items()},
+                    None,
+                )
+            else:
+                entrants = []
+                for i in topology[heat_number][1]:
+                    if i[0] == 'heat':
+                        entrants.append(possible(i[1], i[2]))
+                    else:
+                        entrants.append({i[1]})
+                # Empty seats finish last as pilot 0
+                entrants += [{0}] * (4 - len(entrants))
+                heats[heat_number] = (None, entrants)
+            return heats[heat_number]
 
-        # Build our final leaderboard
-        return [
-            self.try_get_value(results, 16, 1),
-            self.try_get_value(results, 16, 2),
-            self.try_get_value(results, 16, 3),
-            self.try_get_value(results, 16, 4),
-            self.try_get_value(results, 15, 1),
-            self.try_get_value(results, 15, 2),
-            self.try_get_value(results, 15, 3),
-            self.try_get_value(results, 15, 4),
-            a[0],
-            a[1],
-            a[2],
-            a[3],
-            a[4],
-            a[5],
-            a[6],
-            a[7],
-            b[0],
-            b[1],
-            b[2],
-            b[3],
-            b[4],
-            b[5],
-            b[6],
-            b[7],
-            b[8],
-            b[9],
-            b[10],
-            b[11],
-            b[12],
-            b[13],
-            b[14],
-            b[15],
-        ]
+        def possible(heat_number, position):
+            """Pilots that may finish at this position of the heat"""
+            known, entrants = heat(heat_number)
+            if known is not None:
+                return {known.get(position, 0)}
+            # Any pilot of the heat may finish at any position
+            return set().union(*entrants)
 
-    def build_leaderboard_fai16de(self, results, q_pilots):
-        # 9 to 12: 3 and 4 in race 9 and 10
-        a = [
-            self.try_get_value(results, 10, 3),
-            self.try_get_value(results, 10, 4),
-            self.try_get_value(results, 9, 3),
-            self.try_get_value(results, 9, 4),
-        ]
-        # 13 to 16: 3 and 4 in race 5 and 6
-        b = [
-            self.try_get_value(results, 6, 3),
-            self.try_get_value(results, 6, 4),
-            self.try_get_value(results, 5, 3),
-            self.try_get_value(results, 5, 4),
-        ]
+        for heat_number in topology:
+            heat(heat_number)
 
-        # Sort them based on qualifications
-        a = sorted(a, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
-        b = sorted(b, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
+        def q_index(pilot_id):
+            try:
+                return q_pilots.index(pilot_id)
+            except ValueError:
+                return len(q_pilots)
 
-        # Build our final leaderboard
-        return [
-            self.try_get_value(results, 14, 1),
-            self.try_get_value(results, 14, 2),
-            self.try_get_value(results, 14, 3),
-            self.try_get_value(results, 14, 4),
-            self.try_get_value(results, 13, 3),
-            self.try_get_value(results, 13, 4),
-            self.try_get_value(results, 11, 3),
-            self.try_get_value(results, 11, 4),
-            a[0],
-            a[1],
-            a[2],
-            a[3],
-            b[0],
-            b[1],
-            b[2],
-            b[3],
-        ]
+        def count_better(pilot_id, heat_number, positions, own):
+            """Min and max number of pilots better qualified than pilot_id
+            among the ones finishing at these positions of the heat. own is
+            True if pilot_id itself finishes at one of these positions."""
+            known, entrants = heats[heat_number]
+            if known is not None:
+                others = [known.get(p, 0) for p in positions]
+                if own:
+                    others.remove(pilot_id)
+                better = len([x for x in others if q_index(x) < q_index(pilot_id)])
+                return better, better
 
-    def build_leaderboard_fai16(self, results, q_pilots):
-        # 9 to 16: 3 and 4 in race 1 to 4
-        a = [
-            self.try_get_value(results, 1, 3),
-            self.try_get_value(results, 1, 4),
-            self.try_get_value(results, 2, 3),
-            self.try_get_value(results, 2, 4),
-            self.try_get_value(results, 3, 3),
-            self.try_get_value(results, 3, 4),
-            self.try_get_value(results, 4, 3),
-            self.try_get_value(results, 4, 4),
-        ]
+            # Each entrant is a distinct pilot: k positions are filled by k
+            # different entrants, at most one pilot per entrant
+            q = q_index(pilot_id)
+            sets = [e - {pilot_id} for e in entrants]
+            can_better = [any(q_index(x) < q for x in e) for e in sets]
+            can_worse = [any(q_index(x) > q for x in e) for e in sets]
+            k = len(positions)
+            n_better = sum(can_better)
+            n_worse = sum(can_worse)
+            if own:
+                # pilot_id takes one of the positions, and one entrant: the
+                # one giving the widest bounds
+                k -= 1
+                mine = [i for i, e in enumerate(entrants) if pilot_id in e]
+                if all(can_worse[i] for i in mine):
+                    n_worse -= 1
+                if all(can_better[i] for i in mine):
+                    n_better -= 1
+            return max(0, k - n_worse), min(k, n_better)
 
-        # Sort them based on qualifications
-        a = sorted(a, key=lambda pilot: q_pilots.index(pilot['pilot_id']))
+        bounds = {}
+        for base, group in self.bracket_slots(state['bracket_type']):
+            # Positions of the group by heat they come from
+            by_heat = {}
+            for h, p in group:
+                by_heat.setdefault(h, []).append(p)
 
-        # Build our final leaderboard
-        return [
-            self.try_get_value(results, 8, 1),
-            self.try_get_value(results, 8, 2),
-            self.try_get_value(results, 8, 3),
-            self.try_get_value(results, 8, 4),
-            self.try_get_value(results, 7, 1),
-            self.try_get_value(results, 7, 2),
-            self.try_get_value(results, 7, 3),
-            self.try_get_value(results, 7, 4),
-            a[0],
-            a[1],
-            a[2],
-            a[3],
-            a[4],
-            a[5],
-            a[6],
-            a[7],
-        ]
+            for own_heat, own_positions in by_heat.items():
+                known, entrants = heats[own_heat]
+                if known is not None:
+                    pilots = {known.get(p, 0) for p in own_positions}
+                else:
+                    pilots = set().union(*entrants)
+                for pilot_id in pilots - {0}:
+                    best = worst = base
+                    for h, positions in by_heat.items():
+                        surely, maybe = count_better(pilot_id, h, positions, h == own_heat)
+                        best += surely
+                        worst += maybe
+                    if pilot_id in bounds:
+                        best = min(best, bounds[pilot_id][0])
+                        worst = max(worst, bounds[pilot_id][1])
+                    bounds[pilot_id] = (best, worst)
 
-    def build_leaderboard_fai8de(self, results, q_pilots):
-        """These are not official in FAI but that's great to have it"""
-        # Build our final leaderboard
-        return [
-            self.try_get_value(results, 6, 1),
-            self.try_get_value(results, 6, 2),
-            self.try_get_value(results, 6, 3),
-            self.try_get_value(results, 6, 4),
-            self.try_get_value(results, 5, 3),
-            self.try_get_value(results, 5, 4),
-            self.try_get_value(results, 3, 3),
-            self.try_get_value(results, 3, 4),
-        ]
+        analysis = sorted(
+            [
+                {
+                    'pilot_id': pilot_id,
+                    'callsign': PILOT_CACHE.callsign(pilot_id, self._rhapi.db.pilot_by_id),
+                    'best': best,
+                    'worst': worst,
+                }
+                for pilot_id, (best, worst) in bounds.items()
+            ],
+            key=lambda x: (x['best'], x['worst']),
+        )
+        self._whatif[class_id] = (version, analysis)
+        return analysis
 
-    def build_leaderboard_fai8(self, results, q_pilots):
-        """These are not official in FAI but that's great to have it"""
-        # Build our final leaderboard
-        return [
-            self.try_get_value(results, 4, 1),
-            self.try_get_value(results, 4, 2),
-            self.try_get_value(results, 4, 3),
-            self.try_get_value(results, 4, 4),
-            self.try_get_value(results, 3, 1),
-            self.try_get_value(results, 3, 2),
-            self.try_get_value(results, 3, 3),
-            self.try_get_value(results, 3, 4),
-        ]
+    def predict(self, class_id, samples=PREDICT_SAMPLES):
+        """Monte Carlo prediction of the final position of each pilot
+
+        Remaining heats are sampled all at once for every bracket completion,
+        each heat finishing order being drawn with a Plackett-Luce model
+        (Gumbel trick) where pilots are stronger the better they qualified.
+        """
+        state = self.class_state(class_id)
+        if not state:
+            return None
+        version = self._leaderboards[class_id]['version']
+        cached = self._predictions.get(class_id)
+        if not cached or cached[0] != version:
+            cached = self._predictions[class_id] = (version, {})
+        if samples in cached[1]:
+            return cached[1][samples]
+
+        topology = self.state_topology(class_id, state)
+        if topology is None:
+            return None
+        results = state['results']
+        q_pilots = state['q_pilots']
+
+        # Pilots are numbered, 0 being the empty slot
+        pilot_ids = {0}
+        for heat_number, (name, inputs) in topology.items():
+            pilot_ids |= {i[1] for i in inputs if i[0] == 'pilot'}
+            pilot_ids |= {x['pilot_id'] for x in results.get(heat_number, {}).values()}
+        pilot_ids = [0] + sorted(pilot_ids - {0})
+        index = {pilot_id: i for i, pilot_id in enumerate(pilot_ids)}
+
+        # Qualification order, used for strength and for leaderboard tie-breaks
+        q_rank = numpy.array([
+            q_pilots.index(pilot_id) if pilot_id in q_pilots else len(q_pilots)
+            for pilot_id in pilot_ids
+        ])
+        q_rank[0] = len(q_pilots) + 1
+        with numpy.errstate(divide='ignore'):
+            strength = numpy.log(numpy.maximum(len(q_pilots) + 1 - q_rank, 0).astype(float))
+        strength[0] = -numpy.inf
+
+        rng = numpy.random.default_rng()
+        # placed[sample, heat number, position] = pilot index
+        placed = numpy.zeros((samples, len(topology) + 1, 5), dtype=int)
+        done = set()
+
+        def simulate(heat_number):
+            if heat_number in done:
+                return
+            done.add(heat_number)
+            if self.heat_decided(state, topology, heat_number):
+                for position, x in results[heat_number].items():
+                    if 0 < position <= 4:
+                        placed[:, heat_number, position] = index.get(x['pilot_id'], 0)
+                return
+            entrants = []
+            for i in topology[heat_number][1]:
+                if i[0] == 'heat':
+                    simulate(i[1])
+                    entrants.append(placed[:, i[1], i[2]])
+                else:
+                    entrants.append(numpy.full(samples, index[i[1]]))
+            if not entrants:
+                return
+            entrants = numpy.stack(entrants, axis=1)
+            keys = strength[entrants] + rng.gumbel(size=entrants.shape)
+            order = numpy.argsort(-keys, axis=1)
+            finish = numpy.take_along_axis(entrants, order, axis=1)[:, :4]
+            placed[:, heat_number, 1:finish.shape[1] + 1] = finish
+
+        for heat_number in topology:
+            simulate(heat_number)
+
+        groups = self.bracket_slots(state['bracket_type'])
+        positions = groups[-1][0] + len(groups[-1][1]) - 1
+        counts = numpy.zeros((len(pilot_ids), positions), dtype=int)
+        for base, group in groups:
+            members = numpy.stack([placed[:, h, p] for h, p in group], axis=1)
+            if len(group) > 1:
+                order = numpy.argsort(q_rank[members], axis=1, kind='stable')
+                members = numpy.take_along_axis(members, order, axis=1)
+            for j in range(len(group)):
+                numpy.add.at(counts, (members[:, j], base - 1 + j), 1)
+
+        probabilities = counts / samples
+        prediction = {
+            'samples': samples,
+            'positions': positions,
+            'pilots': [
+                {
+                    'pilot_id': pilot_id,
+                    'callsign': PILOT_CACHE.callsign(pilot_id, self._rhapi.db.pilot_by_id),
+                    'probabilities': probabilities[i].round(4).tolist(),
+                }
+                for i, pilot_id in enumerate(pilot_ids) if pilot_id and counts[i].any()
+            ],
+        }
+        cached[1][samples] = prediction
+        return prediction
 
     def guess_bracket(self, class_id):
         """Guess the size of the bracket:
@@ -771,27 +1112,40 @@ class FaiRank():
             fai8de: 6 heats
             fai8: 4 heats
         """
-        s = {
-            62: 'fai64de',
-            32: 'fai64',
-            30: 'fai32de',
-            16: 'fai32',
-            14: 'fai16de',
-            8: 'fai16',
-            6: 'fai8de',
-            4: 'fai8',
-        }
-
         n = len(self._rhapi.db.heats_by_class(class_id))
         try:
-            return s[n]
+            return BRACKET_TYPES[n]
         except KeyError:
             return None
 
-    def try_get_value(self, f, k, s):
-        try:
-            return f[k][s]
-        except Exception:
-            # We use pilot_id 0 with no callsign
-            # Pilot 0 is added at the end of qualif as the last pilot
-            return {'pilot_id': 0, 'callsign': ''}
+    def bracket_slots(self, bracket_type):
+        """Return the leaderboard slots of a bracket type, as a list of groups
+        (base position, [(heat number, heat position), ...])
+        A group of more than one slot is sorted by qualification.
+
+        This is read from the build_leaderboard_* methods themselves: they are
+        fed with fake pilots named after their slot, once with a qualification
+        order and once with the reverse one. Positions that differ are sorted.
+        """
+        if bracket_type in self._slots:
+            return self._slots[bracket_type]
+
+        n = {v: k for k, v in BRACKET_TYPES.items()}[bracket_type]
+        results = {
+            h: {p: {'pilot_id': (h, p), 'callsign': ''} for p in range(1, 5)}
+            for h in range(1, n + 1)
+        }
+        keys = [(h, p) for h in range(1, n + 1) for p in range(1, 5)]
+        forward = [x['pilot_id'] for x in self.build_leaderboard(bracket_type, results, keys + [0])]
+        reverse = [x['pilot_id'] for x in self.build_leaderboard(bracket_type, results, keys[::-1] + [0])]
+
+        groups = []
+        i = 0
+        while i < len(forward):
+            j = i + 1
+            while set(forward[i:j]) != set(reverse[i:j]):
+                j += 1
+            groups.append((i + 1, forward[i:j]))
+            i = j
+        self._slots[bracket_type] = groups
+        return groups
@@ -0,0 +1,36 @@
+''' Ranking worker process for the FAI class ranking
+
+Started by the plugin when "Rank in Worker Process" is enabled. It reads one
+JSON request per line on stdin and writes one JSON reply per line on stdout.
+It only imports the bracket module, never RotorHazard nor the server.
+'''
+
+import sys
+import json
+from bracket import FaiBracket
+
+
+def main():
+    bracket = FaiBracket()
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            leaderboard, results = bracket.compute_leaderboard(
+                request['bracket_type'],
+                request['heats'],
+                request['q_pilots'],
+                request['cta'],
+            )
+            # JSON keys are strings, send results per heat number as pairs
+            reply = {
+                'leaderboard': leaderboard,
+                'results': [[h, list(r.items())] for h, r in results.items()],
+            }
+        except Exception as e:
+            reply = {'error': repr(e)}
+        sys.stdout.write(json.dumps(reply) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
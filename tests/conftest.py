@@ -0,0 +1,12 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# The plugin package, and the stand-ins of RotorHazard, gevent and flask
+# (shared with the load test) so that it can be imported outside of RotorHazard
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'tools')]
+
+from stand_ins import install_stand_ins  # noqa: E402
+
+install_stand_ins()
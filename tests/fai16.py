@@ -0,0 +1,74 @@
+'''fai16 bracket of 16 pilots, with the heats flown so far, behind a stand-in of rhapi'''
+
+import types
+
+import class_rank_fai
+from Database import ProgramMethod
+
+# fai16: heats 1 to 4 are the first round, 5 and 6 the semis,
+# 7 the small final and 8 the final
+SEEDS = {
+    5: [(1, 1), (1, 2), (2, 1), (2, 2)],
+    6: [(3, 1), (3, 2), (4, 1), (4, 2)],
+    7: [(5, 3), (5, 4), (6, 3), (6, 4)],
+    8: [(5, 1), (5, 2), (6, 1), (6, 2)],
+}
+ENTRANTS = {
+    1: [1, 8, 9, 16],
+    2: [2, 3, 4, 5],
+    3: [6, 7, 10, 11],
+    4: [12, 13, 14, 15],
+}
+QUALIFICATION = [9, 1, 16, 2, 3, 8, 4, 5, 6, 7, 10, 11, 12, 13, 14, 15]
+# Heats 2 to 4 are flown, heat 1 is not
+FLOWN = {
+    2: [4, 5, 2, 3],
+    3: [6, 7, 10, 11],
+    4: [12, 13, 14, 15],
+}
+
+
+def make_ranker(flown=FLOWN):
+    """Return a FaiRank of class 2, where the heats of flown (heat number ->
+    finishing order) are flown"""
+    heats = [
+        types.SimpleNamespace(id=100 + n, name="Final" if n == 8 else f"Heat {n}", class_id=2, status=0)
+        for n in range(1, 9)
+    ]
+    races = {100 + n: [types.SimpleNamespace(id=n, heat_id=100 + n)] for n in flown}
+    results = {
+        n: {
+            'meta': {'primary_leaderboard': 'by_race_time'},
+            'by_race_time': [{'pilot_id': p, 'position': i} for i, p in enumerate(order, start=1)],
+        }
+        for n, order in flown.items()
+    }
+
+    def slots_by_heat(heat_id):
+        n = heat_id - 100
+        if n in SEEDS:
+            return [
+                types.SimpleNamespace(method=ProgramMethod.HEAT_RESULT, seed_id=100 + h, seed_rank=p, pilot_id=0)
+                for h, p in SEEDS[n]
+            ]
+        return [
+            types.SimpleNamespace(method=ProgramMethod.ASSIGN, seed_id=None, seed_rank=None, pilot_id=p)
+            for p in ENTRANTS[n]
+        ]
+
+    race_class = types.SimpleNamespace(id=2, name='Bracket', win_condition='', rank_settings={'rank-fai-qualifid': 1})
+    db = types.SimpleNamespace(
+        raceclasses=[race_class],
+        raceclass_by_id=lambda class_id: race_class,
+        raceclass_ranking=lambda class_id: {'ranking': [{'pilot_id': p} for p in QUALIFICATION]},
+        heats_by_class=lambda class_id: heats,
+        races_by_heat=lambda heat_id: races.get(heat_id, []),
+        race_results=lambda race_id: results.get(race_id),
+        pilot_by_id=lambda pilot_id: types.SimpleNamespace(id=pilot_id, callsign=f'Pilot {pilot_id}'),
+        slots_by_heat=slots_by_heat,
+        option=lambda name, default=False, as_int=False: default,
+    )
+    ranker = class_rank_fai.FaiRank(types.SimpleNamespace(db=db))
+    ranker.register_handlers({'register_fn': lambda method: None})
+    race_class.win_condition = ranker._method.name
+    return ranker
@@ -0,0 +1,21 @@
+from fai16 import make_ranker
+
+
+def test_journey():
+    ranker = make_ranker()
+    journey = ranker.journey(2, 4)
+    assert journey['heats'] == [{'heat_number': 2, 'name': 'Heat 2', 'position': 1}]
+    assert ranker.journey(2, 99) is None
+
+
+def test_journey_after_class_stops_ranking():
+    ranker = make_ranker()
+    assert ranker.journey(2, 4)
+
+    # The bracket is not a fai16 anymore and ranks to nothing
+    ranker._rhapi.db.heats_by_class(2).pop()
+    ranker.invalidate({})
+    race_class = ranker._rhapi.db.raceclass_by_id(2)
+    leaderboard, _ = ranker.rank(ranker._rhapi, race_class, ranker.class_settings(race_class))
+    assert leaderboard == []
+    assert ranker.journey(2, 4) is None
@@ -0,0 +1,28 @@
+import pytest
+
+from fai16 import make_ranker
+
+numpy = pytest.importorskip('numpy')
+
+
+def test_predict():
+    ranker = make_ranker()
+    prediction = ranker.predict(2, 500)
+    assert prediction['samples'] == 500
+    assert prediction['positions'] == 16
+
+    # Each position is taken by exactly one pilot in every sample
+    probabilities = numpy.array([pilot['probabilities'] for pilot in prediction['pilots']])
+    assert numpy.allclose(probabilities.sum(axis=0), 1, atol=1e-3)
+    # Cached by number of samples
+    assert ranker.predict(2, 500) is prediction
+    assert ranker.predict(2, 250)['samples'] == 250
+
+
+def test_predict_after_heat_deleted():
+    ranker = make_ranker()
+    assert ranker.predict(2, 250)
+
+    ranker._rhapi.db.heats_by_class(2).pop()
+    ranker.invalidate({})
+    assert ranker.predict(2, 250) is None
@@ -0,0 +1,32 @@
+import os
+
+import class_rank_fai
+from fai16 import make_ranker
+
+
+def test_profile_captures(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(class_rank_fai.gevent, 'spawn', lambda fn, *args: fn(*args))
+    ranker = make_ranker()
+    race_class = ranker._rhapi.db.raceclass_by_id(2)
+    altered = []
+
+    def raceclass_alter(class_id, rank_settings=None):
+        altered.append(class_id)
+        race_class.rank_settings = rank_settings
+    ranker._rhapi.db.raceclass_alter = raceclass_alter
+    race_class.rank_settings = dict(race_class.rank_settings, **{'rank-fai-profile': 2})
+
+    for _ in range(3):
+        ranker.rank(ranker._rhapi, race_class, ranker.class_settings(race_class))
+    # class_state does not use up captures
+    ranker.invalidate({})
+    ranker.class_state(2)
+
+    files = sorted(os.listdir(class_rank_fai.PROFILE_DIR))
+    assert len([f for f in files if f.endswith('.prof')]) == 2
+    assert len([f for f in files if f.endswith('.json')]) == 2
+    # Turned off after the last capture
+    assert altered == [2]
+    assert race_class.rank_settings['rank-fai-profile'] == 0
+    assert race_class.rank_settings['rank-fai-qualifid'] == 1
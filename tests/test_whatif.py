@@ -0,0 +1,95 @@
+import itertools
+
+import pytest
+
+from fai16 import SEEDS, ENTRANTS, QUALIFICATION, FLOWN, make_ranker
+
+
+def finish(order):
+    return {i: {'pilot_id': p, 'callsign': ''} for i, p in enumerate(order, start=1)}
+
+
+def brute_force(ranker, flown, heats):
+    """Min and max leaderboard position of each pilot, over all the possible
+    outcomes of these heats (in bracket order)"""
+    q_pilots = QUALIFICATION + [0]
+    positions = {}
+
+    def complete(results, heats):
+        if not heats:
+            leaderboard = ranker.build_leaderboard('fai16', results, q_pilots)
+            for position, row in enumerate(leaderboard, start=1):
+                if row['pilot_id']:
+                    positions.setdefault(row['pilot_id'], set()).add(position)
+            return
+        n = heats[0]
+        if n in SEEDS:
+            entrants = [results[h][p]['pilot_id'] for h, p in SEEDS[n]]
+        else:
+            entrants = ENTRANTS[n]
+        for order in itertools.permutations(entrants):
+            complete({**results, n: finish(order)}, heats[1:])
+
+    complete({n: finish(order) for n, order in flown.items()}, heats)
+    return {pilot_id: (min(p), max(p)) for pilot_id, p in positions.items()}
+
+
+def whatif(ranker):
+    return {row['pilot_id']: (row['best'], row['worst']) for row in ranker.whatif(2)}
+
+
+def test_whatif_first_round():
+    ranker = make_ranker()
+    analysis = whatif(ranker)
+    # Semis are not flown either: only pilots eliminated in the first round
+    # get a position, this checks the 9 to 16 group
+    expected = brute_force(ranker, FLOWN, [1])
+
+    # Pilots eliminated in flown heats: both bounds are exact
+    for n, order in FLOWN.items():
+        for pilot_id in order[2:]:
+            assert analysis[pilot_id] == expected[pilot_id], pilot_id
+    assert analysis[2] == (10, 11)
+    assert analysis[3] == (11, 12)
+
+    # Pilots of heat 1 may still win the final, or be eliminated in the first round
+    for pilot_id in ENTRANTS[1]:
+        assert analysis[pilot_id] == (1, expected[pilot_id][1]), pilot_id
+
+
+@pytest.mark.parametrize('semis', [{}, {5: [4, 9, 5, 1]}])
+def test_whatif_semis_and_finals(semis):
+    first_round = {
+        1: [9, 1, 16, 8],
+        2: [4, 5, 2, 3],
+        3: [6, 7, 10, 11],
+        4: [12, 13, 14, 15],
+    }
+    flown = {**first_round, **semis}
+    ranker = make_ranker(flown)
+    analysis = whatif(ranker)
+    expected = brute_force(ranker, flown, [n for n in range(5, 9) if n not in flown])
+
+    assert set(analysis) == set(expected)
+    for pilot_id, (best, worst) in analysis.items():
+        assert (best, worst) == expected[pilot_id], pilot_id
+    if semis:
+        # Winners of heat 5 are in the final, the others in the small final
+        assert analysis[4] == (1, 4)
+        assert analysis[1] == (5, 8)
+
+
+def test_whatif_after_heat_deleted():
+    ranker = make_ranker()
+    assert ranker.whatif(2)
+
+    # Before the event is handled, the topology does not match the ranking
+    ranker._rhapi.db.heats_by_class(2).pop()
+    assert ranker.state_topology(2, ranker.class_state(2)) is None
+
+    # Ranked again, the class is not a bracket anymore
+    ranker.invalidate({})
+    race_class = ranker._rhapi.db.raceclass_by_id(2)
+    leaderboard, _ = ranker.rank(ranker._rhapi, race_class, ranker.class_settings(race_class))
+    assert leaderboard == []
+    assert ranker.whatif(2) is None
@@ -0,0 +1,244 @@
+'''Race-day load test of the FAI ranking
+
+Replays a synthetic fai64de event heat by heat, through an in-memory
+stand-in of rhapi, while concurrent readers request the class ranking
+(like clients polling the results). Heats are seeded from the fai64de
+bracket topology by the plugin itself, as on a LAPS_SAVE event.
+Reports throughput and rank latency.
+
+Run from the repository root: RotorHazard modules, gevent and flask are
+stood in for when they are not installed. Run from a RotorHazard server
+directory to use the real ones:
+
+    python tools/loadtest.py --readers 50 --interval 0.5
+'''
+
+import os
+import sys
+import time
+import types
+import random
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from stand_ins import install_stand_ins
+
+QUALIFICATION_CLASS_ID = 1
+BRACKET_CLASS_ID = 2
+HEATS = 62
+PILOTS = 64
+
+
+def fai64de_seeds():
+    """Return the seeds of each heat number of the fai64de bracket, as lists
+    of (heat number, position), or None for first round heats"""
+    def winners(a, b):
+        return [(a, 1), (a, 2), (b, 1), (b, 2)]
+
+    def losers(a, b):
+        return [(a, 3), (a, 4), (b, 3), (b, 4)]
+
+    seeds = {h: None for h in range(1, 17)}
+    for i in range(8):
+        seeds[17 + i] = winners(1 + 2 * i, 2 + 2 * i)
+        seeds[25 + i] = losers(1 + 2 * i, 2 + 2 * i)
+        seeds[33 + i] = [(25 + i, 1), (25 + i, 2), (17 + i, 3), (17 + i, 4)]
+    for i in range(4):
+        seeds[41 + i] = winners(33 + 2 * i, 34 + 2 * i)
+        seeds[45 + i] = winners(17 + 2 * i, 18 + 2 * i)
+        seeds[49 + i] = [(41 + i, 1), (41 + i, 2), (45 + i, 3), (45 + i, 4)]
+    for i in range(2):
+        seeds[53 + i] = winners(49 + 2 * i, 50 + 2 * i)
+        seeds[55 + i] = winners(45 + 2 * i, 46 + 2 * i)
+        seeds[57 + i] = [(53 + i, 1), (53 + i, 2), (55 + i, 3), (55 + i, 4)]
+    seeds[59] = winners(57, 58)
+    seeds[60] = winners(55, 56)
+    seeds[61] = [(59, 1), (59, 2), (60, 3), (60, 4)]
+    seeds[62] = winners(60, 61)
+    return seeds
+
+
+class FakeDB():
+    """In-memory stand-in of rhapi.db, with a results cache like RotorHazard's"""
+    def __init__(self, ranker, seed):
+        self.ranker = ranker
+        self.rnd = random.Random(seed)
+        self.pilots = {i: types.SimpleNamespace(id=i, callsign=f'Pilot {i}') for i in range(1, PILOTS + 1)}
+        qualification = list(self.pilots)
+        self.rnd.shuffle(qualification)
+        self.qualification = {'ranking': [{'pilot_id': p} for p in qualification], 'meta': {'method_label': 'Laps'}}
+        self.raceclasses = [
+            types.SimpleNamespace(id=QUALIFICATION_CLASS_ID, name='Qualification', win_condition='', rank_settings=None),
+            types.SimpleNamespace(id=BRACKET_CLASS_ID, name='Bracket', win_condition='',
+                                  rank_settings={'rank-fai-qualifid': QUALIFICATION_CLASS_ID,
+                                                 'rank-fai-advance': True}),
+        ]
+        self.heats = [
+            types.SimpleNamespace(id=100 + i, name="Final" if i == HEATS else f"Heat {i}",
+                                  class_id=BRACKET_CLASS_ID, status=0)
+            for i in range(1, HEATS + 1)
+        ]
+        # First round heats get pilots in qualification order, others are
+        # seeded from heat results
+        self.slots = {}
+        for heat_number, seeds in fai64de_seeds().items():
+            heat_id = 100 + heat_number
+            if seeds is None:
+                self.slots[heat_id] = [
+                    types.SimpleNamespace(id=heat_id * 10 + i, method=0, seed_id=None, seed_rank=None,
+                                          pilot_id=qualification[(heat_number - 1) * 4 + i])
+                    for i in range(4)
+                ]
+            else:
+                self.slots[heat_id] = [
+                    types.SimpleNamespace(id=heat_id * 10 + i, method=1, seed_id=100 + h, seed_rank=p, pilot_id=0)
+                    for i, (h, p) in enumerate(seeds)
+                ]
+        self.races = {}
+        self.results = {}
+        self.options = {}
+
+        self.lock = threading.Lock()
+        self.cache = None
+        self.rank_latencies = []
+
+    def save_heat(self, heat):
+        """Save a race for the heat, with its seeded pilots in random order"""
+        race_id = len(self.results) + 1
+        pilots = [slot.pilot_id for slot in self.slots[heat.id]]
+        if 0 in pilots:
+            raise RuntimeError(f'{heat.name} was not seeded')
+        self.rnd.shuffle(pilots)
+        with self.lock:
+            self.races[heat.id] = [types.SimpleNamespace(id=race_id, heat_id=heat.id)]
+            self.results[race_id] = {
+                'meta': {'primary_leaderboard': 'by_race_time'},
+                'by_race_time': [{'pilot_id': p, 'position': i} for i, p in enumerate(pilots, start=1)],
+            }
+            self.cache = None
+        # What the plugin does on LAPS_SAVE
+        self.ranker.advance_bracket({'race_id': race_id})
+        self.ranker.invalidate({'race_id': race_id})
+
+    def raceclass_ranking(self, class_id):
+        if class_id == QUALIFICATION_CLASS_ID:
+            return self.qualification
+        with self.lock:
+            if self.cache is None:
+                race_class = self.raceclass_by_id(class_id)
+                start = time.perf_counter()
+                leaderboard, meta = self.ranker.rank(None, race_class, self.ranker.class_settings(race_class))
+                self.rank_latencies.append(time.perf_counter() - start)
+                self.cache = {'ranking': leaderboard, 'meta': meta}
+            return self.cache
+
+    def raceclass_by_id(self, class_id):
+        return next((c for c in self.raceclasses if c.id == class_id), None)
+
+    def heats_by_class(self, class_id):
+        return [h for h in self.heats if h.class_id == class_id]
+
+    def heat_by_id(self, heat_id):
+        return next((h for h in self.heats if h.id == heat_id), None)
+
+    def races_by_heat(self, heat_id):
+        return self.races.get(heat_id, [])
+
+    def race_results(self, race_id):
+        return self.results.get(race_id)
+
+    def pilot_by_id(self, pilot_id):
+        return self.pilots.get(pilot_id)
+
+    def race_by_id(self, race_id):
+        return next((r for races in self.races.values() for r in races if r.id == race_id), None)
+
+    def slots_by_heat(self, heat_id):
+        return self.slots.get(heat_id, [])
+
+    def slots_alter_fast(self, slot_list):
+        slots = {slot.id: slot for slots in self.slots.values() for slot in slots}
+        for update in slot_list:
+            slots[update['slot_id']].pilot_id = update['pilot']
+
+    def option(self, name, default=False, as_int=False):
+        return self.options.get(name, default)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(p / 100 * (len(values) - 1)))]
+
+
+def report(name, latencies, elapsed):
+    print(f'{name}: {len(latencies)} calls, {len(latencies) / elapsed:.1f}/s, '
+          f'p50 {percentile(latencies, 50) * 1000:.2f}ms, '
+          f'p95 {percentile(latencies, 95) * 1000:.2f}ms, '
+          f'p99 {percentile(latencies, 99) * 1000:.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readers', type=int, default=50, help='concurrent readers polling the ranking')
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between two heat saves')
+    parser.add_argument('--poll', type=float, default=1.0, help='seconds between two polls of a reader')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic event')
+    parser.add_argument('--worker', action='store_true', help='rank in a worker process')
+    args = parser.parse_args()
+
+    install_stand_ins()
+    import class_rank_fai
+
+    ranker = class_rank_fai.FaiRank(None)
+    db = FakeDB(ranker, args.seed)
+    ranker._rhapi = types.SimpleNamespace(db=db, ui=types.SimpleNamespace(broadcast_heats=lambda: None))
+    if args.worker:
+        db.options['fai-rank-worker'] = '1'
+
+    methods = []
+    ranker.register_handlers({'register_fn': methods.append})
+    db.raceclasses[1].win_condition = methods[0].name
+
+    done = threading.Event()
+    read_latencies = []
+
+    def reader():
+        latencies = []
+        while not done.is_set():
+            start = time.perf_counter()
+            db.raceclass_ranking(BRACKET_CLASS_ID)
+            latencies.append(time.perf_counter() - start)
+            if args.poll:
+                time.sleep(args.poll)
+        read_latencies.extend(latencies)
+
+    readers = [threading.Thread(target=reader, daemon=True) for _ in range(args.readers)]
+    start = time.perf_counter()
+    for t in readers:
+        t.start()
+
+    for heat in db.heats:
+        db.save_heat(heat)
+        time.sleep(args.interval)
+
+    done.set()
+    for t in readers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    leaderboard = db.raceclass_ranking(BRACKET_CLASS_ID)['ranking']
+    distinct = len({row['pilot_id'] for row in leaderboard} - {0})
+    print(f'{HEATS} heats saved, {args.readers} readers, {elapsed:.1f}s, '
+          f'{len(leaderboard)} leaderboard rows, {distinct} distinct pilots')
+    report('reads', read_latencies, elapsed)
+    report('rank', db.rank_latencies, elapsed)
+    print(f'pilot cache: {class_rank_fai.PILOT_CACHE.stats()}')
+    ranker.stop_worker()
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,7 @@ def calc_heat_pilots(heat):
         return
 
     slots = Database.HeatNode.query.filter_by(heat_id=heat.id).all()
+    seed_pilots = {}
     for slot in slots:
         if slot.method == ProgramMethod.NONE:
             slot.pilot_id = RHUtils.PILOT_ID_NONE
@@ -24,22 +25,24 @@ def calc_heat_pilots(heat):
         elif slot.method == ProgramMethod.HEAT_RESULT:
             if slot.seed_id:
                 if slot.seed_rank:
-                    seed_heat = Database.Heat.query.filter_by(id=slot.seed_id).first()
-                    print(f'For heat {heat.name} looking rank in {seed_heat.name}')
-                    # We are supposed to take the result, but we dont have it (painful to build it)
-                    # Anyway, our lowest pilot id is always first, let's fake this
-                    heatnodes = Database.HeatNode.query.filter_by(heat_id=seed_heat.id).all()
-                    pilots = sorted([x.pilot_id for x in heatnodes if x.pilot_id != 0])
-                    print(f'Found pilots: {pilots}')
-                    slot.pilot_id = pilots[slot.seed_rank - 1]
+                    if slot.seed_id not in seed_pilots:
+                        seed_heat = Database.Heat.query.filter_by(id=slot.seed_id).first()
+                        print(f'For heat {heat.name} looking rank in {seed_heat.name}')
+                        # We are supposed to take the result, but we dont have it (painful to build it)
+                        # Anyway, our lowest pilot id is always first, let's fake this
+                        heatnodes = Database.HeatNode.query.filter_by(heat_id=seed_heat.id).all()
+                        seed_pilots[slot.seed_id] = sorted([x.pilot_id for x in heatnodes if x.pilot_id != 0])
+                        print(f'Found pilots: {seed_pilots[slot.seed_id]}')
+                    slot.pilot_id = seed_pilots[slot.seed_id][slot.seed_rank - 1]
         elif slot.method == ProgramMethod.CLASS_RESULT:
             if slot.seed_id:
                 if slot.seed_rank:
                     seed_class = Database.RaceClass.query.filter_by(id=slot.seed_id).first()
                     positions = seed_class.ranking['ranking']
                     slot.pilot_id = positions[slot.seed_rank - 1]['pilot_id']
-        Database.DB_session.commit()
-        Database.DB_session.flush()
+    # Commit all slots at once
+    Database.DB_session.commit()
+    Database.DB_session.flush()
 
 for heat in Database.Heat.query.all():
     #print(json.dumps(heat.results))
@@ -0,0 +1,92 @@
+'''Stand-ins of the RotorHazard modules, gevent and flask used by the plugin,
+so that it can be imported outside of a RotorHazard server (load test, tests)
+'''
+
+import sys
+import time
+import types
+import importlib
+import threading
+import subprocess
+
+
+def install_stand_ins():
+    """Provide the RotorHazard modules used by the plugin when not running inside RotorHazard
+    Returns the names of the modules that were stood in for"""
+    class UIField():
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    class RaceClassRankMethod():
+        def __init__(self, label, rank_fn, default_args=None, settings=None, name=None):
+            self.label = label
+            self.name = name or label.lower()
+            self.rank_fn = rank_fn
+            self.default_args = default_args or {}
+            self.settings = settings or []
+
+    class Response():
+        def __init__(self, response=None, status=200, mimetype=None):
+            self.response = response
+            self.status = status
+            self.mimetype = mimetype
+            self.headers = {}
+
+    class Timeout():
+        """Never fires: a blocked thread cannot be interrupted"""
+        def __init__(self, seconds=None, exception=None):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    class Blueprint():
+        def __init__(self, name, import_name, url_prefix=None):
+            self.name = name
+
+        def route(self, rule):
+            return lambda fn: fn
+
+    events = ('CLASS_RANK_INITIALIZE', 'STARTUP', 'LAPS_SAVE', 'LAPS_RESAVE', 'HEAT_ADD', 'HEAT_DUPLICATE',
+              'HEAT_GENERATE', 'HEAT_ALTER', 'HEAT_DELETE', 'CLASS_ALTER', 'CLASS_DELETE', 'PILOT_ALTER',
+              'PILOT_DELETE', 'DATABASE_RESET', 'DATABASE_RESTORE', 'DATABASE_RECOVER', 'DATABASE_IMPORT')
+    stand_ins = {
+        'RHUtils': {'PILOT_ID_NONE': 0},
+        'eventmanager': {'Evt': types.SimpleNamespace(**{e: e.lower() for e in events})},
+        'RHRace': {'StartBehavior': types.SimpleNamespace()},
+        'Results': {'RaceClassRankMethod': RaceClassRankMethod},
+        'RHUI': {
+            'UIField': UIField,
+            'UIFieldType': types.SimpleNamespace(CHECKBOX='checkbox', SELECT='select', BASIC_INT='basic_int', TEXT='text'),
+            'UIFieldSelectOption': lambda value, label: types.SimpleNamespace(value=value, label=label),
+        },
+        'Database': {
+            'ProgramMethod': types.SimpleNamespace(NONE=-1, ASSIGN=0, HEAT_RESULT=1, CLASS_RESULT=2),
+            'HeatStatus': types.SimpleNamespace(PLANNED=0, PROJECTED=1, CONFIRMED=2),
+        },
+        # The load test uses threads, gevent is stood in by the standard library
+        'gevent': {
+            'sleep': time.sleep,
+            'spawn': lambda fn, *args: threading.Thread(target=fn, args=args, daemon=True).start(),
+            'subprocess': subprocess,
+            'lock': types.SimpleNamespace(Semaphore=threading.Semaphore),
+            'Timeout': Timeout,
+        },
+        'flask': {'Blueprint': Blueprint, 'Response': Response, 'request': None},
+    }
+    installed = []
+    for name, attrs in stand_ins.items():
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            module = types.ModuleType(name)
+            module.__dict__.update(attrs)
+            sys.modules[name] = module
+            installed.append(name)
+    if 'gevent' in installed:
+        sys.modules['gevent.subprocess'] = subprocess
+        sys.modules['gevent.lock'] = sys.modules['gevent'].lock
+    return installed